@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 from argparse import RawTextHelpFormatter
 from plexapi.myplex import MyPlexAccount
-import os, re, sys, urllib, argparse, requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import os, re, sys, json, time, ntpath, argparse, requests, threading
 import config as cfg
+try: from orjson import loads as json_loads # use orjson to parse shoko's (potentially very large) file list faster if it is installed
+except ImportError: from json import loads as json_loads
 
 r"""
 Description:
@@ -15,6 +20,7 @@ Author:
   - natyusha
 Requirements:
   - Python 3.7+, Python-PlexAPI (pip install plexapi), Requests Library (pip install requests), Plex, ShokoRelay, Shoko Server
+  - Optional: orjson (pip install orjson) for faster processing of large Shoko libraries
 Preferences:
   - Before doing anything with this script you must enter your Plex and Shoko Server credentials into config.py.
   - If your anime is split across multiple libraries they can all be added in a python list under Plex "LibraryNames".
@@ -27,6 +33,9 @@ Usage:
       - (watched-sync.py 2w) would return results from the last 2 weeks
       - (watched-sync.py 3d) would return results from the last 3 days
   - The full list of suffixes (from 1-999) are: m=minutes, h=hours, d=days, w=weeks, mon=months, y=years
+  - Without a relative date only episodes watched since the last fully successful run without one will be synced (or everything on the first run).
+      - Use a relative date like (watched-sync.py 999y) to force a full sync e.g. after matching previously unrecognized files in Shoko.
+      - Changing the configured server, libraries or users will automatically trigger a full sync.
   - Append the argument "import" (watched-sync.py import) if you want to sync watched states from Shoko to Plex instead.
       - The script will ask for (Y/N) confirmation for each Plex user that has been configured.
 Behaviour:
@@ -36,22 +45,37 @@ Behaviour:
 sys.stdout.reconfigure(encoding='utf-8') # allow unicode characters in print
 error_prefix = '\033[31m⨯\033[0m' # use the red terminal colour for ⨯
 
-# unbuffered print command to allow the user to see progress immediately
-def print_f(text): print(text, flush=True)
+# unbuffered print command to allow the user to see progress immediately (locked so that threaded output doesn't interleave)
+print_lock = threading.Lock()
+def print_f(text):
+    with print_lock: print(text, flush=True)
 
-# relative date regex definition and import check for argument type
+# relative date regex definition (1-999 followed by a suffix) and import check for argument type
+relative_date_regex = re.compile(r'^[1-9][0-9]{0,2}(?:m|h|d|w|mon|y)$')
 def arg_parse(arg):
     arg = arg.lower()
-    if not re.match('^(?:[1-9]|[1-9][0-9]|[1-9][0-9][0-9])(?:m|h|d|w|mon|y)$', arg) and arg != 'import':
+    if not relative_date_regex.match(arg) and arg != 'import':
         raise argparse.ArgumentTypeError('invalid range or import')
     return arg
 
 # check the arguments if the user is looking to use a relative date or not
 parser = argparse.ArgumentParser(description='Sync watched states from Plex to Shoko.', epilog='NOTE: In "import" mode the script will ask for (Y/N) confirmation for each Plex user that has been configured.', formatter_class=RawTextHelpFormatter)
-parser.add_argument('relative_date', metavar='range | import', nargs='?', type=arg_parse, default='999y', help='range:  Limit the time range (from 1-999) for syncing watched states.\n        *must be the sole argument and is entered as Integer+Suffix\n        *the full list of suffixes are:\n        m=minutes\n        h=hours\n        d=days\n        w=weeks\n        mon=months\n        y=years\n\nimport: If you want to sync watched states from Shoko to Plex instead.\n        *must be the sole argument and is simply entered as "import"')
+parser.add_argument('relative_date', metavar='range | import', nargs='?', type=arg_parse, help='range:  Limit the time range (from 1-999) for syncing watched states.\n        *must be the sole argument and is entered as Integer+Suffix\n        *without a range only episodes watched since the last sync without one are checked\n        *the full list of suffixes are:\n        m=minutes\n        h=hours\n        d=days\n        w=weeks\n        mon=months\n        y=years\n\nimport: If you want to sync watched states from Shoko to Plex instead.\n        *must be the sole argument and is simply entered as "import"')
 relative_date, shoko_import = parser.parse_args().relative_date, False
 if relative_date == 'import': relative_date, shoko_import = '999y', True
 
+# without a relative date only sync episodes viewed since the last successful sync that also had none (if there was one)
+# an hour is taken off the start time to allow for clock differences between this machine and the plex server
+# sync times are saved per server, library and user configuration so that adding a library or user triggers a full sync for it
+sync_start, sync_failed = int(time.time()) - 3600, False
+sync_key = json.dumps([cfg.Plex['ServerName'], sorted(cfg.Plex['LibraryNames']), sorted(cfg.Plex['ExtraUsers'] or []), cfg.Shoko['Hostname'], cfg.Shoko['Port']])
+last_sync_file = os.path.join(os.path.expanduser('~'), '.cache', 'shokorelay', 'last_sync.json')
+try:
+    with open(last_sync_file, 'r') as file: last_sync = json.load(file)
+except Exception: last_sync = {}
+viewed_after = f'-{relative_date or "999y"}'
+if relative_date is None and sync_key in last_sync: viewed_after = last_sync[sync_key]
+
 # authenticate and connect to the Plex server/library specified
 try:
     if cfg.Plex['X-Plex-Token']:
@@ -70,17 +94,84 @@ if cfg.Plex['ExtraUsers']:
         data = [admin.query(f'https://plex.tv/api/home/users/{user.id}/switch', method=admin._session.post) for user in extra_users]
         for userID in data: accounts.append(MyPlexAccount(token=userID.attrib.get('authenticationToken')))
     except Exception as error: # if the extra users can't be found show an error and continue
+        sync_failed = True
         print(f'{error_prefix}Failed:', error)
 
+# base url for all shoko api calls
+shoko_url = f'http://{cfg.Shoko["Hostname"]}:{cfg.Shoko["Port"]}/api'
+
+# use a persistent session for all shoko calls so that the connection is kept alive between requests
+# the connection pool is sized to match the number of worker threads so that each thread can hold its own connection open
+# requests are also retried with a backoff if shoko is temporarily unavailable so a single failure doesn't abort the whole sync
+max_workers = 16
+session = requests.Session()
+retries = Retry(total=5, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=['GET', 'POST'])
+session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retries))
+
 # grab a shoko api key using the credentials from the prefs
 try:
-    auth = requests.post(f'http://{cfg.Shoko["Hostname"]}:{cfg.Shoko["Port"]}/api/auth', json={'user': cfg.Shoko['Username'], 'pass': cfg.Shoko['Password'], 'device': 'ShokoRelay Scripts for Plex'}).json()
+    auth = session.post(f'{shoko_url}/auth', json={'user': cfg.Shoko['Username'], 'pass': cfg.Shoko['Password'], 'device': 'ShokoRelay Scripts for Plex'}).json()
 except Exception:
     print(f'{error_prefix}Failed: Unable to Connect to Shoko Server')
     exit(1)
 if 'status' in auth and auth['status'] in (400, 401):
     print(f'{error_prefix}Failed: Shoko Credentials Invalid')
     exit(1)
+session.headers['apikey'] = auth['apikey'] # attach the api key to every subsequent request
+
+# yield the filename and title of every watched episode part in a plex library straight from the xml to avoid building full episode objects
+def watched_parts(plex, library_key, page_size=500):
+    start = 0
+    while True:
+        container = plex.query(f'/library/sections/{library_key}/all?type=4&unwatched=0&lastViewedAt%3E%3E={viewed_after}&X-Plex-Container-Start={start}&X-Plex-Container-Size={page_size}')
+        episodes = container.findall('Video')
+        for episode in episodes:
+            for part in episode.iter('Part'): yield os.path.sep + os.path.basename(part.attrib['file']), episode.attrib['title'] # add a path separator to the filename to avoid duplicate matches
+        if len(episodes) < page_size: break
+        start += page_size
+
+# only keep the parts of a shoko file record needed for syncing so the index stays small for large libraries
+def file_state(file): return {'ID': file['ID'], 'Watched': file['Watched'], 'Matched': bool(file['SeriesIDs'])}
+
+# grab every file in shoko once and index them by filename so that episodes can be looked up without a request each
+# the files are requested a page at a time so that only one page of the response is ever held in memory
+def build_file_index(page_size=1000):
+    try:
+        page = 1
+        while True:
+            shoko_files = json_loads(session.get(f'{shoko_url}/v3/File', params={'pageSize': page_size, 'page': page, 'include': 'XRefs'}).content)['List']
+            for file in shoko_files:
+                state = file_state(file)
+                for location in file['Locations']: # ntpath is used as it splits on both separators in case shoko is running on a different platform
+                    file_index[os.path.sep + ntpath.basename(location['RelativePath'])] = state
+            if len(shoko_files) < page_size: break # a short page means that there are no more files left to request
+            page += 1
+    except Exception as error: # if the index can't be built every file will be looked up individually instead
+        file_index.clear()
+        print_f(f'│{error_prefix}─Failed: Unable to Index Shoko Files ({error})')
+
+class NotMatched(Exception): pass # label for files that shoko doesn't have matched
+
+# relay the watched state of a single plex episode part to shoko if it isn't already marked as watched there
+def sync_episode(filepath, episode_title):
+    global sync_failed
+    index_thread.join() # wait for the background index to finish on the first lookup
+    try:
+        if filepath not in file_index: # fall back to querying shoko for files missing from the index and cache the result for other libraries/users
+            path_ends_with = session.get(f'{shoko_url}/v3/File/PathEndsWith', params={'path': filepath, 'limit': 0}).json()
+            file_index[filepath] = file_state(path_ends_with[0]) if isinstance(path_ends_with, list) and path_ends_with else None
+        shoko_file = file_index[filepath]
+        if shoko_file is None: raise NotMatched # files that shoko doesn't know about can't be marked as watched
+        if shoko_file['Watched'] == None:
+            if not shoko_file['Matched']: raise NotMatched # unrecognised files have no episodes to mark as watched
+            session.post(f'{shoko_url}/v3/File/{shoko_file["ID"]}/Watched/true').raise_for_status() # marks every episode linked to the file in a single call
+            print_f(f'│├─Relaying: {filepath} → {episode_title}')
+            shoko_file['Watched'] = True # update the indexed record so that other libraries/users skip the file without relaying it again
+    except NotMatched: # unmatched files don't fail the sync as they usually stay that way, a full sync can pick them up once they are matched
+        print_f(f'│├{error_prefix}─Failed: Make sure that "{filepath}" is matched by Shoko')
+    except Exception as error: # connection or server errors are reported separately so they aren't mistaken for matching problems
+        sync_failed = True
+        print_f(f'│├{error_prefix}─Failed: Unable to Relay "{filepath}" ({error})')
 
 # loop through all of the accounts listed and sync watched states
 print_f('\n┌ShokoRelay Watched Sync')
@@ -88,9 +179,15 @@ print_f('\n┌ShokoRelay Watched Sync')
 if shoko_import == True:
     print_f(f'├─Generating: Shoko Watched Episode List...')
     watched_episodes = []
-    shoko_watched = requests.get(f'http://{cfg.Shoko["Hostname"]}:{cfg.Shoko["Port"]}/api/v3/Episode?pageSize=0&page=1&includeWatched=only&includeFiles=true&apikey={auth["apikey"]}').json()
+    shoko_watched = session.get(f'{shoko_url}/v3/Episode?pageSize=0&page=1&includeWatched=only&includeFiles=true').json()
     for file in shoko_watched['List']:
         watched_episodes.append(os.path.basename(file['Files'][0]['Locations'][0]['RelativePath']))
+# otherwise start indexing shoko's files in the background so the download overlaps with connecting to plex and querying the first library
+else:
+    print_f(f'├─Generating: Shoko File Index...')
+    file_index = {}
+    index_thread = threading.Thread(target=build_file_index, daemon=True) # daemon so an early exit doesn't wait for the download
+    index_thread.start()
 
 for account in accounts:
     # if importing ask the user to confirm syncing for each username
@@ -116,6 +213,7 @@ for account in accounts:
         try:
             anime = plex.library.section(library)
         except Exception as error:
+            sync_failed = True
             print(f'│{error_prefix}─Failed', error)
             continue
 
@@ -128,17 +226,20 @@ for account in accounts:
                         episode.markPlayed()
                         print_f(f'│├─Importing: {filepath}')
         else:
-            # loop through all the watched episodes in the plex library within the time frame of the relative date
-            for episode in anime.searchEpisodes(unwatched=False, filters={'lastViewedAt>>': relative_date}):
-                for episode_path in episode.iterParts():
-                    filepath = os.path.sep + os.path.basename(episode_path.file) # add a path separator to the filename to avoid duplicate matches
-                    path_ends_with = requests.get(f'http://{cfg.Shoko["Hostname"]}:{cfg.Shoko["Port"]}/api/v3/File/PathEndsWith?path={urllib.parse.quote(filepath)}&limit=0&apikey={auth["apikey"]}').json()
-                    try:
-                        if path_ends_with[0]['Watched'] == None:
-                            print_f(f'│├─Relaying: {filepath} → {episode.title}')
-                            for EpisodeID in path_ends_with[0]['SeriesIDs'][0]['EpisodeIDs']:
-                                requests.post(f'http://{cfg.Shoko["Hostname"]}:{cfg.Shoko["Port"]}/api/v3/Episode/{EpisodeID["ID"]}/Watched/true?apikey={auth["apikey"]}')
-                    except Exception:
-                        print(f'│├{error_prefix}─Failed: Make sure that "{filepath}" is matched by Shoko')
+            # loop through all the watched episodes in the plex library within the time frame of the relative date (one thread per unique file)
+            # duplicate filenames are dropped so that two threads can't relay the same file at once, later libraries/users rely on the index instead
+            episode_parts = dict(watched_parts(plex, anime.key))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(sync_episode, episode_parts.keys(), episode_parts.values()))
         print_f('│└─Finished!')
+
+# remember when this sync started so that the next run without a relative date can skip everything viewed before it
+# nothing is saved if anything failed so that those episodes are checked again next time
+if relative_date is None and not sync_failed:
+    try:
+        os.makedirs(os.path.dirname(last_sync_file), exist_ok=True)
+        last_sync[sync_key] = sync_start
+        with open(last_sync_file, 'w') as file: json.dump(last_sync, file)
+    except Exception as error:
+        print(f'{error_prefix}Failed: Unable to Save Last Sync Time', error)
 print('└Watched Sync Complete')